@@ -45,7 +45,7 @@ import solar_download_linke_gui
 
 
 T_WIDTH = 480
-T_HEIGHT = 480
+T_HEIGHT = 580
 
 
 def main():
@@ -43,6 +43,7 @@ try:
     import ttk
     from Tkconstants import *
     import tkFileDialog as filedialog
+    import tkMessageBox as messagebox
     # import tkFont as font
 
 except ImportError:
@@ -50,8 +51,11 @@ except ImportError:
     import tkinter.ttk as ttk
     from tkinter.constants import *
     import tkinter.filedialog as filedialog
+    import tkinter.messagebox as messagebox
     # import tkinter.font as font
 
+import os
+
 import solar_download_linke_utils
 
 # FONTS
@@ -62,13 +66,14 @@ ENTRY_FONT = ('Arial', 10)
 TOOLTIP_FONT = ('Arial', 9)
 
 ROOT_WIDTH = 480
-ROOT_HEIGHT = 480
+ROOT_HEIGHT = 580
 
 # TOOLTIPS
 SELECTDEM_TT = """Select the DEM (.tif) to use for determining the extent 
 to download the Linke turbidity coefficients."""
 
-EPSG_TT = """Enter the EPSG Code of Coordinate System of the DEM.
+EPSG_TT = """Enter the EPSG Code of Coordinate System of the DEM
+(leave blank to read it from the DEM).
 
 Commonly used EPSG Codes:
 4326  - WGS84
@@ -78,16 +83,47 @@ INTERVAL_TT="""Enter the interval (in decimal degrees)
 between successive Linke turbidity coefficient downloads"""
 
 SELECTTXT_TT = """Select the text (.txt) file containing coordinates formatted
-as longitude, latitude in the WGS84 coordinate system"""
+as x, y (longitude, latitude) in the coordinate system of the EPSG Code.
+Fields may be separated by commas, semicolons, tabs, pipes or spaces.
+Lines starting with # and a header row are skipped."""
+
+TXTEPSG_TT = """Enter the EPSG Code of the coordinates in the text file
+(leave blank for WGS84)"""
+
+DECIMALS_TT = """Enter the number of decimals to round the coordinates to
+(leave blank to keep them as is). Duplicate points are skipped."""
 
 BOUND_TT = "The %s (decimal degrees) of the %s edge of the bounding box"
 
-PROXY_TT = "Enter the proxy server (if any)"
+PROXY_TT = """Enter the proxy server (if any). Several proxies can be entered
+separated by commas as host or host:port to spread the downloads"""
 
-PORT_TT = "Enter the proxy port (if any)"
+PORT_TT = "Enter the proxy port (if any) of the proxies entered without one"
 
 SELECTSAVE_TT = "Select the save file (.csv) to download the Linke turbidity values to"
 
+UPDATESAVE_TT = "Append only the points that are not yet in the save file"
+
+SELECTGRIDS_TT = """Select the directory of the 12 monthly SoDA Linke turbidity
+grids (.tif) to read the values from instead of the SoDA webservice"""
+
+PLAN_TT = """Count the points to download and estimate the runtime
+without downloading. Invalid lines of a coordinates file are reported. A coverage preview (<save file>_preview.png)
+is written next to the save file, replacing any earlier preview."""
+
+NOT_PLANNED_MSG = """The points have not been counted yet.
+Use PLAN to count them and estimate the runtime. PLAN also reads the whole
+coordinates file, so an invalid line is found before the download starts."""
+
+PROGRESSIVE_TT = """Download the grid at the coarsest power-of-two stride first
+(the largest power of two up to the intervals along its longer side),
+then at half the stride and so on, so that an interrupted download
+still covers the whole area at a coarser interval
+(DEM and bounding box only)"""
+
+COMPACTSAVE_TT = """Sort the save file and remove duplicate points
+after downloading"""
+
 class ToolTip(object):
     """
     A class that creates a tooltip for a given widget when the mouse hovers
@@ -146,6 +182,13 @@ class DownloadLinkeApp(tk.Frame):
         self.saveModeVar.set('w')
         self.savePathVar = tk.StringVar()
         self.savePathVar.set('')
+        self.compactVar = tk.IntVar()
+        self.compactVar.set(0)
+        self.gridsPathVar = tk.StringVar()
+        self.gridsPathVar.set('')
+        self.progressiveVar = tk.IntVar()
+        self.progressiveVar.set(0)
+        self.planned = None
 
         '''Widgets'''
         self.headMast = tk.Label(self,
@@ -265,6 +308,36 @@ class DownloadLinkeApp(tk.Frame):
         self.selectTxtTT = ToolTip(self.selectTxtBtn,
                                    SELECTTXT_TT)
 
+        self.txtEpsgLabel = tk.Label(self.option1Frame,
+                                     text='EPSG Code',
+                                     relief=GROOVE,
+                                     width=14,
+                                     pady=2,
+                                     padx=2,
+                                     font=LABEL_FONT)
+        self.txtEpsgLabel.grid(row=1, column=0, sticky=E+W)
+        self.txtEpsgEntry = tk.Entry(self.option1Frame,
+                                     width=18,
+                                     font=ENTRY_FONT)
+        self.txtEpsgEntry.grid(row=1, column=1, sticky=E+W)
+        self.txtEpsgTT = ToolTip(self.txtEpsgEntry,
+                                 TXTEPSG_TT)
+
+        self.decimalsLabel = tk.Label(self.option1Frame,
+                                      text='Decimals',
+                                      relief=GROOVE,
+                                      width=14,
+                                      pady=2,
+                                      padx=2,
+                                      font=LABEL_FONT)
+        self.decimalsLabel.grid(row=1, column=2, sticky=E+W)
+        self.decimalsEntry = tk.Entry(self.option1Frame,
+                                      width=18,
+                                      font=ENTRY_FONT)
+        self.decimalsEntry.grid(row=1, column=3, sticky=E+W)
+        self.decimalsTT = ToolTip(self.decimalsEntry,
+                                  DECIMALS_TT)
+
         # OPTION2 - BOUNDING BOX
         self.option2 = tk.Radiobutton(self,
                                       text='Use a bounding box to define extent',
@@ -422,6 +495,28 @@ class DownloadLinkeApp(tk.Frame):
                                          relief=RAISED,
                                          overrelief=SUNKEN)
         self.appendSave.grid(row=2, column=2, columnspan=3, sticky=E+W)
+
+        self.updateSave = tk.Radiobutton(self.downloadOptionsFrame,
+                                         text="Update Save File",
+                                         width=26,
+                                         variable=self.saveModeVar,
+                                         value='i',
+                                         relief=RAISED,
+                                         overrelief=SUNKEN)
+        self.updateSave.grid(row=3, column=0, columnspan=2, sticky=E+W)
+        self.updateSaveTT = ToolTip(self.updateSave,
+                                    UPDATESAVE_TT)
+
+        self.compactSave = tk.Checkbutton(self.downloadOptionsFrame,
+                                          text="Compact Save File",
+                                          width=26,
+                                          variable=self.compactVar,
+                                          relief=RAISED,
+                                          overrelief=SUNKEN)
+        self.compactSave.grid(row=3, column=2, columnspan=3, sticky=E+W)
+        self.compactSaveTT = ToolTip(self.compactSave,
+                                     COMPACTSAVE_TT)
+
         self.saveFileBtn = tk.Button(self.downloadOptionsFrame,
                                      text="Save File",
                                      command=self.select_save,
@@ -429,17 +524,45 @@ class DownloadLinkeApp(tk.Frame):
                                      pady=2,
                                      padx=2,
                                      font=LABEL_FONT)
-        self.saveFileBtn.grid(row=3, column=0, sticky=E+W)
+        self.saveFileBtn.grid(row=4, column=0, sticky=E+W)
         self.savePath = tk.Entry(self.downloadOptionsFrame,
                                  textvariable=self.savePathVar,
                                  readonlybackground='white',
                                  state='readonly',
                                  width=50,
                                  font=ENTRY_FONT)
-        self.savePath.grid(row=3, column=1, columnspan=4, sticky=E+W)
+        self.savePath.grid(row=4, column=1, columnspan=4, sticky=E+W)
         self.savePathTT = ToolTip(self.saveFileBtn,
                                   SELECTSAVE_TT)
 
+        self.gridsBtn = tk.Button(self.downloadOptionsFrame,
+                                  text="Linke Grids",
+                                  command=self.select_grids,
+                                  width=14,
+                                  pady=2,
+                                  padx=2,
+                                  font=LABEL_FONT)
+        self.gridsBtn.grid(row=5, column=0, sticky=E+W)
+        self.gridsPath = tk.Entry(self.downloadOptionsFrame,
+                                  textvariable=self.gridsPathVar,
+                                  readonlybackground='white',
+                                  state='readonly',
+                                  width=50,
+                                  font=ENTRY_FONT)
+        self.gridsPath.grid(row=5, column=1, columnspan=4, sticky=E+W)
+        self.gridsPathTT = ToolTip(self.gridsBtn,
+                                   SELECTGRIDS_TT)
+
+        self.progressive = tk.Checkbutton(self.downloadOptionsFrame,
+                                          text="Coarse-to-fine Order",
+                                          width=26,
+                                          variable=self.progressiveVar,
+                                          relief=RAISED,
+                                          overrelief=SUNKEN)
+        self.progressive.grid(row=6, column=0, columnspan=2, sticky=E+W)
+        self.progressiveTT = ToolTip(self.progressive,
+                                     PROGRESSIVE_TT)
+
         self.downloadBtn = tk.Button(self.downloadOptionsFrame,
                                      text="DOWNLOAD LINKE",
                                      command=self.download_linke,
@@ -447,7 +570,18 @@ class DownloadLinkeApp(tk.Frame):
                                      height=1,
                                      font=RADIOBUTTON_FONT,
                                      activebackground='yellow')
-        self.downloadBtn.grid(row=4, column=0, columnspan=2, sticky=E+W)
+        self.downloadBtn.grid(row=7, column=0, columnspan=2, sticky=E+W)
+
+        self.planBtn = tk.Button(self.downloadOptionsFrame,
+                                 text="PLAN",
+                                 command=self.plan_download,
+                                 width=26,
+                                 height=1,
+                                 font=RADIOBUTTON_FONT,
+                                 activebackground='yellow')
+        self.planBtn.grid(row=7, column=2, columnspan=3, sticky=E+W)
+        self.planTT = ToolTip(self.planBtn,
+                              PLAN_TT)
 
         self.select_options()
 
@@ -466,6 +600,9 @@ class DownloadLinkeApp(tk.Frame):
         for radButton in [self.option0, self.option1, self.option2]:
             radButton.config(state=NORMAL)
 
+        # The points of a coordinates file are not on a grid to thin out
+        self.progressive.config(state=DISABLED if opt == 1 else NORMAL)
+
         self.set_readonly_entries(opt)
 
         self.update()
@@ -518,45 +655,178 @@ class DownloadLinkeApp(tk.Frame):
         else:
             self.savePathVar.set(save)
 
-    def download_linke(self):
+    def select_grids(self):
+        grids = filedialog.askdirectory(parent=self,
+                                        title='Select directory of monthly Linke turbidity grids')
+        if grids is None:
+            self.gridsPathVar.set('')
+        else:
+            self.gridsPathVar.set(grids)
+
+    def get_coords(self):
+        """Returns an iterable of the lon,lat tuples of the selected option"""
+        coords, interval = self.get_option_coords()
+
+        if self.progressiveVar.get() and interval is not None:
+            coords = solar_download_linke_utils.progressive_order(coords, interval)
+
+        return coords
+
+    def get_option_coords(self):
+        """Returns an iterable of the lon,lat tuples of the selected option
+        and the interval of their grid (None if they are not on a grid)
+        """
+        opt = self.optionVar.get()
+
+        if opt == 0:
+            dem = self.demPathVar.get()
+            crs = self.epsgEntry.get().strip()
+            interval = float(self.interval0Entry.get().strip())
+            return solar_download_linke_utils.iter_extent_of_DEM(dem,
+                                                                 crs,
+                                                                 interval), interval
+
+        if opt == 1:
+            crs = self.txtEpsgEntry.get().strip()
+            decimals = self.decimalsEntry.get().strip()
+            return solar_download_linke_utils.iter_coords_file(
+                self.txtPathVar.get(),
+                crs_epsg=crs or None,
+                decimals=int(decimals) if decimals else None,
+                unique=True), None
+
+        if opt == 2:
+            w, e, s, n, i = self.get_bbox()
+            return solar_download_linke_utils.iter_bbox_coords(w, e, s, n, i), i
+
+    def get_bbox(self):
+        """Returns the west, east, south, north and interval of the bounding box"""
+        return (float(self.wEntry.get().strip()),
+                float(self.eEntry.get().strip()),
+                float(self.sEntry.get().strip()),
+                float(self.nEntry.get().strip()),
+                float(self.interval2Entry.get().strip()))
+
+    def get_plan_coords(self):
+        """Returns an iterable of the lon,lat tuples still to be downloaded"""
+        coords = self.get_option_coords()[0]
+
+        if self.saveModeVar.get() == 'i':
+            done = solar_download_linke_utils.load_downloaded_coords(self.savePathVar.get().strip())
+            coords = solar_download_linke_utils.filter_downloaded(coords, done)
+
+        return coords
+
+    def get_plan_key(self):
+        """Returns the settings that the plan of the selected option depends on"""
+        return (self.optionVar.get(),
+                self.demPathVar.get(), self.epsgEntry.get(), self.interval0Entry.get(),
+                self.txtPathVar.get(), self.txtEpsgEntry.get(), self.decimalsEntry.get(),
+                self.wEntry.get(), self.eEntry.get(), self.sEntry.get(), self.nEntry.get(),
+                self.interval2Entry.get(),
+                self.saveModeVar.get(), self.savePathVar.get(), self.gridsPathVar.get(),
+                self.proxyEntry.get(), self.portEntry.get())
+
+    def get_plan(self, preview=True):
+        """Returns the plan_download summary of the selected option. The
+        bounding box is counted arithmetically, the DEM and text file points
+        are counted in one pass over them.
+        :param preview: write the coverage preview next to the save file
+        """
         opt = self.optionVar.get()
+        saveFile = self.savePathVar.get().strip()
+        grids = self.gridsPathVar.get().strip()
+
+        if grids != '':
+            provider = solar_download_linke_utils.LocalRasterProvider
+            concurrency = provider.concurrency
+        else:
+            provider = solar_download_linke_utils.SodaWebProvider
+            proxies = solar_download_linke_utils.parse_proxies(self.proxyEntry.get().strip(),
+                                                               self.portEntry.get().strip())
+            concurrency = max(1, len(proxies))
+
+        previewFile = None
+        if preview and saveFile != '':
+            previewFile = os.path.splitext(saveFile)[0] + "_preview.png"
+
+        if opt == 2 and self.saveModeVar.get() != 'i':
+            w, e, s, n, i = self.get_bbox()
+            plan = solar_download_linke_utils.plan_download(
+                None, provider.latency, concurrency, previewFile, (w, e, s, n),
+                solar_download_linke_utils.count_bbox_coords(w, e, s, n, i))
+            return solar_download_linke_utils.format_plan(plan)
+
+        bounds = None
+        if previewFile is not None:
+            if opt == 0:
+                lons, lats = solar_download_linke_utils.get_extent_grid(
+                    self.demPathVar.get(),
+                    self.epsgEntry.get().strip(),
+                    float(self.interval0Entry.get().strip()))[:2]
+                if len(lons) and len(lats):
+                    bounds = (lons[0], lons[-1], lats[0], lats[-1])
+
+            elif opt == 1:
+                bounds = solar_download_linke_utils.get_coords_bounds(self.get_plan_coords())[1]
+
+            else:
+                bounds = self.get_bbox()[:4]
+
+            if bounds is None:
+                previewFile = None
+
+        plan = solar_download_linke_utils.plan_download(self.get_plan_coords(),
+                                                        provider.latency,
+                                                        concurrency,
+                                                        previewFile,
+                                                        bounds)
+        return solar_download_linke_utils.format_plan(plan)
+
+    def plan_download(self):
+        try:
+            plan = self.get_plan()
+            self.planned = (self.get_plan_key(), plan)
+            messagebox.showinfo('Download Plan', plan, parent=self)
+
+        except Exception as e:
+            messagebox.showerror('Download Plan', str(e), parent=self)
+
+    def download_linke(self):
         proxy = self.proxyEntry.get().strip()
         port = self.portEntry.get().strip()
         saveFile = self.savePathVar.get().strip()
         saveMode = self.saveModeVar.get().strip()
+        compact = bool(self.compactVar.get())
+        grids = self.gridsPathVar.get().strip()
 
-        # print opt, proxy, port, saveFile, saveMode
+        # print proxy, port, saveFile, saveMode
 
         try:
-            if opt == 0:
-                dem = self.demPathVar.get()
-                crs = self.epsgEntry.get().strip()
-                interval = float(self.interval0Entry.get().strip())
-                coords = solar_download_linke_utils.get_extent_of_DEM(dem,
-                                                                      crs,
-                                                                      interval)
-                self.deactivate_all()
-                solar_download_linke_utils.download_linke(coords, proxy, port, saveFile, saveMode)
-
-            if opt == 1:
-                coords = []
-                with open(self.txtPathVar.get(), 'r') as f:
-                    for line in f.readlines():
-                        line0 = line.strip('\n')
-                        line1 = line0.split(',')
-                        coords.append((float(line1[0]),float(line1[1])))
-                self.deactivate_all()
-                solar_download_linke_utils.download_linke(coords, proxy, port, saveFile, saveMode)
-
-            if opt == 2:
-                w = float(self.wEntry.get().strip())
-                e = float(self.eEntry.get().strip())
-                s = float(self.sEntry.get().strip())
-                n = float(self.nEntry.get().strip())
-                i = float(self.interval2Entry.get().strip())
-                coords = [(w + (x*i), s + (y*i)) for x in range(int((e - w)/i)+1) for y in range(int((n - s)/i)+1)]
-                self.deactivate_all()
-                solar_download_linke_utils.download_linke(coords, proxy, port, saveFile, saveMode)
+            '''Only the bounding box is planned here, the DEM and text file
+            points are counted by PLAN.'''
+            if self.optionVar.get() == 2 and saveMode != 'i':
+                plan = self.get_plan(preview=False)
+            elif self.planned is not None and self.planned[0] == self.get_plan_key():
+                plan = self.planned[1]
+            else:
+                plan = NOT_PLANNED_MSG
+
+            if not messagebox.askokcancel('Download Plan',
+                                          plan + "\n\nStart the download?",
+                                          parent=self):
+                return
+
+            provider = None
+            if grids != '':
+                provider = solar_download_linke_utils.LocalRasterProvider(
+                    solar_download_linke_utils.find_monthly_grids(grids))
+
+            coords = self.get_coords()
+            self.deactivate_all()
+            self.planned = None
+            solar_download_linke_utils.download_linke(coords, proxy, port, saveFile, saveMode,
+                                                      compact, provider)
 
         except Exception as e:
             self.select_options()
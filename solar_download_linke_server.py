@@ -0,0 +1,444 @@
+"""
+LINKE TURBIDITY LOOKUP SERVICE
+A long-running local HTTP/JSON service that serves Linke turbidity
+coefficient values to several jobs at once through one shared connection
+to the SoDA (Solar Radiation Data) webservice (www.soda-is.com).
+
+Values are looked up in a bounded in-memory LRU cache, then in a persistent
+SQLite store and only then downloaded. When several callers ask for the same
+point while it is being downloaded, only one upstream request is made.
+
+Endpoints:
+GET  /linke?lon=121.0&lat=14.0
+POST /linke  with a body of {"points": [[121.0, 14.0], [121.25, 14.0]]}
+GET  /stats
+
+To run the service, go to the directory and type:
+python solar_download_linke_server.py --store linke_store.sqlite
+
+NB:
+The Tool has only been tested for *buntu (Linux) OS and Python 2.7
+The requirements/modules used are found in the included requirements.txt
+This Tool is provided under the GNU General Public License v3.0.
+
+Copyright (C) 2015 Ben Hur S. Pintor
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = "Ben Hur S. Pintor"
+__contact__ = "bhs.pintor<at>gmail.com"
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+import argparse
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+import solar_download_linke_utils
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8642
+DEFAULT_CACHE_SIZE = 100000
+MAX_BATCH = 10000
+
+# The seconds a caller waits for a point while no point at all is fetched
+# from the provider. A long batch of another caller that keeps fetching
+# does not time out the callers waiting on its points.
+FLIGHT_TIMEOUT = 600
+
+
+def coord_key(lon, lat):
+    """Returns the '%0.5f' lon,lat strings that identify a point, the same
+    as the ones written to the output file by download_linke.
+    """
+
+    return (format(float(lon), '0.5f'), format(float(lat), '0.5f'))
+
+
+class LRUCache(object):
+    """A thread-safe dict that keeps at most size of the most recently used
+    items.
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class LinkeStore(object):
+    """A persistent SQLite store of the monthly Linke turbidity strings keyed
+    by the '%0.5f' lon,lat strings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS linke ("
+                        "lon TEXT, lat TEXT, linkes TEXT, "
+                        "PRIMARY KEY (lon, lat))")
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT linkes FROM linke WHERE lon=? AND lat=?",
+                                  key).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, linkes):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO linke VALUES (?, ?, ?)",
+                            (key[0], key[1], linkes))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class _Flight(object):
+    """An upstream request in progress that callers of the same point wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.linkes = None
+        self.error = None
+
+
+class LinkeService(object):
+    """Looks up Linke turbidity values in the cache, then the store and only
+    then from the provider. Concurrent lookups of the same point share one
+    upstream request and all upstream requests go through one provider.
+    """
+
+    def __init__(self, providerFactory, store, cacheSize=DEFAULT_CACHE_SIZE):
+        """Initializes the service.
+        :param providerFactory: a callable returning the LinkeProvider to use,
+                                called again after the provider fails
+        :param store: the LinkeStore to persist the values to
+        :param cacheSize: the number of points kept in memory
+        """
+
+        self.providerFactory = providerFactory
+        self.provider = None
+        self.store = store
+        self.cache = LRUCache(cacheSize)
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.upstream = threading.Lock()
+        self.lastProgress = 0.0
+        self.stats = collections.Counter()
+
+    def lookup(self, coords):
+        """Returns the monthly Linke turbidity values of the coordinates.
+
+        :param coords: a list of lon,lat tuples
+        :returns: a list of (lon, lat, linkes, error) tuples in the same order
+                  as coords where lon,lat are the '%0.5f' strings and linkes
+                  is the comma-separated monthly values or None
+        """
+
+        start = time.time()
+        keys = [coord_key(lon, lat) for lon, lat in coords]
+        results = {}
+        waiting = {}
+        leading = collections.OrderedDict()
+
+        with self.lock:
+            for key in keys:
+                if key in results or key in waiting:
+                    continue
+
+                linkes = self.cache.get(key)
+                if linkes is not None:
+                    self.stats['cache_hits'] += 1
+                    results[key] = (linkes, None)
+                    continue
+
+                flight = self.flights.get(key)
+                if flight is None:
+                    flight = _Flight()
+                    self.flights[key] = flight
+                    leading[key] = flight
+                else:
+                    self.stats['coalesced'] += 1
+                waiting[key] = flight
+
+        if leading:
+            self._lead(leading)
+
+        for key, flight in waiting.items():
+            if self._wait(flight, start):
+                results[key] = (flight.linkes, flight.error)
+            else:
+                self._abandon(key, flight)
+                results[key] = (None, 'timed out')
+
+        return [key + results[key] for key in keys]
+
+    def _wait(self, flight, start):
+        """Waits for a flight as long as the provider keeps fetching points.
+
+        :param flight: the _Flight to wait for
+        :param start: the time the lookup started
+        :returns: False if no point was fetched for FLIGHT_TIMEOUT seconds
+        """
+
+        while True:
+            remaining = max(start, self.lastProgress) + FLIGHT_TIMEOUT - time.time()
+            if remaining <= 0:
+                return flight.event.is_set()
+            if flight.event.wait(remaining):
+                return True
+
+    def _abandon(self, key, flight):
+        """Unregisters a stalled flight so that the next lookup of the point
+        makes a new upstream request instead of waiting on it.
+        """
+
+        with self.lock:
+            self.stats['timeouts'] += 1
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def _lead(self, flights):
+        """Resolves the flights of the points this caller is responsible for.
+        The upstream lock is only held for one provider batch at a time so
+        that the points of other callers can be fetched in between.
+
+        :param flights: an ordered dict of the keys to resolve and their
+                        _Flight
+        """
+
+        pending = collections.OrderedDict(flights)
+        try:
+            misses = []
+            for key in list(pending):
+                linkes = self.store.get(key)
+                if linkes is not None:
+                    self._count('store_hits')
+                    self._finish(key, pending.pop(key), linkes)
+                else:
+                    misses.append(key)
+
+            start = 0
+            while start < len(misses):
+                with self.upstream:
+                    self.lastProgress = time.time()
+                    if self.provider is None:
+                        self.provider = self.providerFactory()
+
+                    batch = misses[start:start + max(1, self.provider.batchSize)]
+                    coords = [(float(lon), float(lat)) for lon, lat in batch]
+                    for index, (lon, lat, linkes) in enumerate(self.provider.fetch(coords)):
+                        key = batch[index]
+                        self.lastProgress = time.time()
+                        self._count('upstream')
+                        if linkes is not None:
+                            linkes = solar_download_linke_utils.format_linkes(linkes)
+                            self.store.put(key, linkes)
+                        self._finish(key, pending.pop(key), linkes)
+
+                start += len(batch)
+
+        except Exception as e:
+            self._count('upstream_errors')
+            with self.upstream:
+                self._reset_provider()
+            for key, flight in pending.items():
+                self._finish(key, flight, None, str(e))
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _reset_provider(self):
+        """Drops the provider so that the next upstream request reconnects"""
+
+        provider, self.provider = self.provider, None
+        if provider is not None:
+            try:
+                provider.close()
+            except Exception:
+                pass
+
+    def _finish(self, key, flight, linkes, error=None):
+        """Caches the values of a point and wakes up the callers waiting on
+        its flight. Only the given flight is removed, so a newer flight for
+        the same point is left to its own leader.
+        """
+
+        with self.lock:
+            if linkes is not None:
+                self.cache.put(key, linkes)
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+        flight.linkes = linkes
+        flight.error = error
+        flight.event.set()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self.flights)
+            stats['cached'] = len(self.cache)
+        return stats
+
+
+def format_result(lon, lat, linkes, error):
+    result = {'lon': lon, 'lat': lat, 'linke': None}
+    if linkes is not None:
+        result['linke'] = [float(v) for v in linkes.split(',')]
+    if error is not None:
+        result['error'] = error
+    return result
+
+
+class LinkeRequestHandler(BaseHTTPRequestHandler):
+    """Handles the JSON requests to the LinkeService of the server"""
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+
+        if url.path == '/stats':
+            self.send_json(200, service.get_stats())
+            return
+
+        if url.path != '/linke':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        query = parse_qs(url.query)
+        try:
+            coord = (float(query['lon'][0]), float(query['lat'][0]))
+        except (KeyError, ValueError):
+            self.send_json(400, {'error': 'expected numeric lon and lat'})
+            return
+
+        self.send_json(200, format_result(*service.lookup([coord])[0]))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        service = self.server.service
+
+        if url.path != '/linke':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            coords = [(float(p[0]), float(p[1])) for p in body['points']]
+        except (KeyError, IndexError, TypeError, ValueError):
+            self.send_json(400, {'error': 'expected {"points": [[lon, lat], ...]}'})
+            return
+
+        if len(coords) > MAX_BATCH:
+            self.send_json(400, {'error': 'at most %i points per request' % MAX_BATCH})
+            return
+
+        results = [format_result(*r) for r in service.lookup(coords)]
+        self.send_json(200, {'results': results})
+
+
+class LinkeServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server sharing one LinkeService between requests"""
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, LinkeRequestHandler)
+        self.service = service
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Linke turbidity lookup service')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--store', default='linke_store.sqlite',
+                        help='the SQLite file to persist the values to')
+    parser.add_argument('--cache', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='the number of points kept in memory')
+    parser.add_argument('--proxy', default='',
+                        help='the proxy servers separated by commas (if any)')
+    parser.add_argument('--proxy-port', default='',
+                        help='the port of the proxies given without one')
+    parser.add_argument('--grids', default='',
+                        help='the directory of the 12 monthly Linke turbidity grids '
+                             'to use instead of the SoDA webservice')
+    args = parser.parse_args()
+
+    if args.grids:
+        grids = solar_download_linke_utils.find_monthly_grids(args.grids)
+        factory = lambda: solar_download_linke_utils.LocalRasterProvider(grids)
+    else:
+        factory = lambda: solar_download_linke_utils.SodaWebProvider(args.proxy,
+                                                                     args.proxy_port)
+
+    store = LinkeStore(args.store)
+    service = LinkeService(factory, store, args.cache)
+    server = LinkeServer((args.host, args.port), service)
+
+    print("Serving Linke turbidity values on http://%s:%i" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
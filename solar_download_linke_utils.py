@@ -31,20 +31,43 @@ __author__ = "Ben Hur S. Pintor"
 __contact__ = "bhs.pintor<at>gmail.com"
 
 
+import collections
+import csv
+import itertools
+import multiprocessing
+import os
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 from requests import Session
 from robobrowser import RoboBrowser
 from osgeo import gdal
+from osgeo import osr
 from osgeo.gdalconst import *
+import numpy as np
 import pyproj
 
 
+STRIP_POINTS = 250000
+COORDS_CHUNK = 100000
+COORDS_DELIMITERS = ',;\t|'
+FLUSH_SIZE = 1000
+FLUSH_INTERVAL = 30
+PROGRESS_INTERVAL = 1
+ROW_FORMAT = ['%0.5f', '%0.5f'] + ['%0.1f'] * 12
+PREVIEW_SIZE = 256
+
+
 def map_to_pixel(gtf, mx, my):
-    """Transforms map coordinates to pixel coordinates using the geotransform
-    parameters of an image.+
+    """Transforms map coordinates to pixel coordinates using the inverse of
+    the geotransform parameters of an image (including rotation terms).
     :param gtf: the geotransform parameters
-    :param mx: the x map coordinate to be transformed
-    :param my: the y map coordinate to be transformed
-    :return: the transformed pixel coordinates
+    :param mx: the x map coordinate(s) to be transformed
+    :param my: the y map coordinate(s) to be transformed
+    :return: the transformed pixel coordinates (numpy arrays if mx and my
+             are arrays)
     """
 
     '''Get values of the geotransform parameters.'''
@@ -52,12 +75,55 @@ def map_to_pixel(gtf, mx, my):
     yorigin = float(gtf[3])
     pixelwidth = float(gtf[1])
     pixelheight = float(gtf[5])
+    xrotation = float(gtf[2])
+    yrotation = float(gtf[4])
 
     '''Compute for the transformed pixel coordinates.'''
-    px = int((mx - xorigin) / pixelwidth)
-    py = int((my - yorigin) / pixelheight)
+    det = (pixelwidth * pixelheight) - (xrotation * yrotation)
+    dx = np.asarray(mx, dtype=np.float64) - xorigin
+    dy = np.asarray(my, dtype=np.float64) - yorigin
+    px = np.floor(((pixelheight * dx) - (xrotation * dy)) / det)
+    py = np.floor(((pixelwidth * dy) - (yrotation * dx)) / det)
+
+    if np.ndim(px) == 0:
+        return (int(px), int(py))
+
+    return (px.astype(np.int64), py.astype(np.int64))
+
+
+def get_dem_crs(dem, crs_epsg=None):
+    """Returns the EPSG code of the coordinate reference system of a DEM or
+    None if the DEM is already in WGS84 longitude,latitude and needs no
+    reprojection.
+
+    :param dem: the gdal raster object of the DEM
+    :param crs_epsg: the EPSG code entered by the user, read from the
+                     projection of the DEM if None or blank
+    :returns: the EPSG code as a string or None
+    """
+
+    if crs_epsg not in (None, ''):
+        crs_epsg = str(crs_epsg).strip()
+        return None if crs_epsg == '4326' else crs_epsg
 
-    return (px, py)
+    wkt = dem.GetProjection()
+    if not wkt:
+        raise ValueError("The DEM has no projection, enter its EPSG code")
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+
+    if srs.IsGeographic() and srs.IsSameGeogCS(wgs84):
+        return None
+
+    srs.AutoIdentifyEPSG()
+    code = srs.GetAuthorityCode(None)
+    if code is None:
+        raise ValueError("Cannot identify the EPSG code of the DEM, enter it manually")
+
+    return None if code == '4326' else code
 
 
 def get_extent_of_DEM(dem_name, crs_epsg, interval):
@@ -66,59 +132,365 @@ def get_extent_of_DEM(dem_name, crs_epsg, interval):
     of downloads to areas within the DEM.
 
     :param dem: the gdal raster object of the DEM
-    :param crs: the coordinate reference system of the input DEM
+    :param crs: the coordinate reference system of the input DEM (read from
+                the DEM if None or blank)
     :interval: the interval between points to be donwloaded (in degrees)
     :returns: a list of lat,lon tuples
     """
 
+    return list(iter_extent_of_DEM(dem_name, crs_epsg, interval, processes=1))
+
+
+def get_extent_grid(dem_name, crs_epsg, interval):
+    """Returns the lon and lat axes of the download grid covering the DEM.
+
+    :param dem_name: the path of the DEM
+    :param crs_epsg: the EPSG code of the coordinate reference system of the
+                     DEM (read from the DEM if None or blank)
+    :param interval: the interval between points to be downloaded (in degrees)
+    :returns: a tuple of the lon and lat numpy arrays of the grid and the
+              EPSG code of the DEM (None if it is in WGS84 lon,lat)
+    """
+
     gdal.AllRegister()
     dem = gdal.Open(dem_name)
-    crs = pyproj.Proj(init="epsg:%s" %crs_epsg)
-    wgs84 = pyproj.Proj(init="epsg:4326")
-
-    coords = []
+    crs_epsg = get_dem_crs(dem, crs_epsg)
 
     gtf = dem.GetGeoTransform()
     incols = dem.RasterXSize
     inrows = dem.RasterYSize
+
+    '''The four corners of the DEM, which may be rotated.'''
+    cols = np.array([0, incols, 0, incols], dtype=np.float64)
+    rows = np.array([0, 0, inrows, inrows], dtype=np.float64)
+    xs = gtf[0] + (cols * gtf[1]) + (rows * gtf[2])
+    ys = gtf[3] + (cols * gtf[4]) + (rows * gtf[5])
+
+    if crs_epsg is not None:
+        crs = pyproj.Proj(init="epsg:%s" %crs_epsg)
+        wgs84 = pyproj.Proj(init="epsg:4326")
+        xs, ys = pyproj.transform(crs, wgs84, xs, ys)
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+    lonwest, loneast = xs.min(), xs.max()
+    latsouth, latnorth = ys.min(), ys.max()
+
+    nlon = int(np.ceil((loneast + (2 * interval) - lonwest) / interval))
+    nlat = int(np.ceil((latnorth + (2 * interval) - latsouth) / interval))
+
+    lons = lonwest + (interval * np.arange(max(nlon, 0)))
+    lats = latsouth + (interval * np.arange(max(nlat, 0)))
+
+    return lons, lats, crs_epsg
+
+
+_extent_worker = {}
+
+
+def _init_extent_worker(dem_name, crs_epsg, lats):
+    """Opens the DEM once per worker process. Each worker keeps its own GDAL
+    handle and only reads the windows of the raster that its strips cover.
+    """
+
+    gdal.AllRegister()
+    dem = gdal.Open(dem_name, GA_ReadOnly)
     band = dem.GetRasterBand(1)
-    data = band.ReadAsArray(0, 0, incols, inrows)
-    nodata = band.GetNoDataValue()
-
-    xorigin = gtf[0]
-    xsize = gtf[1]
-    yorigin = gtf[3]
-    ysize = gtf[5]
-    xlast = xorigin + (xsize * incols)
-    ylast = yorigin + (ysize * inrows)
-
-    lonwest, latnorth = pyproj.transform(crs, wgs84, xorigin, yorigin)
-    loneast, latsouth = pyproj.transform(crs, wgs84, xlast, ylast)
-    lon = lonwest
-    lat = latsouth
-
-    while lon < (loneast + (2 * interval)):
-        while lat < (latnorth + (2 * interval)):
-            mx, my = pyproj.transform(wgs84, crs, lon, lat)
-            px, py = map_to_pixel(gtf, mx, my)
-            if px > (incols - 1) or py > (inrows - 1):
-                pass
-
-            elif px < 0 or py < 0:
-                pass
 
+    _extent_worker['dem'] = dem
+    _extent_worker['band'] = band
+    _extent_worker['nodata'] = band.GetNoDataValue()
+    _extent_worker['gtf'] = dem.GetGeoTransform()
+    if crs_epsg is None:
+        _extent_worker['crs'] = None
+    else:
+        _extent_worker['crs'] = pyproj.Proj(init="epsg:%s" %crs_epsg)
+    _extent_worker['wgs84'] = pyproj.Proj(init="epsg:4326")
+    _extent_worker['lats'] = lats
+
+
+def _extent_strip(lons):
+    """Returns the lon and lat arrays of the valid points of a strip of
+    columns of the download grid, ordered lon first then lat.
+    """
+
+    w = _extent_worker
+    dem = w['dem']
+    gtf = w['gtf']
+    incols = dem.RasterXSize
+    inrows = dem.RasterYSize
+
+    lon = np.repeat(lons, len(w['lats']))
+    lat = np.tile(w['lats'], len(lons))
+
+    if w['crs'] is None:
+        mx, my = lon, lat
+    else:
+        mx, my = pyproj.transform(w['wgs84'], w['crs'], lon, lat)
+
+    px, py = map_to_pixel(gtf, mx, my)
+
+    inside = (px >= 0) & (py >= 0) & (px <= incols - 1) & (py <= inrows - 1)
+    if not inside.any():
+        return lon[:0], lat[:0]
+
+    lon = lon[inside]
+    lat = lat[inside]
+    px = px[inside]
+    py = py[inside]
+
+    xoff = int(px.min())
+    yoff = int(py.min())
+    data = w['band'].ReadAsArray(xoff, yoff,
+                                 int(px.max()) - xoff + 1,
+                                 int(py.max()) - yoff + 1)
+
+    if w['nodata'] is None:
+        valid = np.ones(len(lon), dtype=bool)
+    else:
+        valid = data[py - yoff, px - xoff] != w['nodata']
+
+    return np.round(lon[valid], 5), np.round(lat[valid], 5)
+
+
+def _iter_bounded(pool, func, args, window):
+    """Yields the results of func over args from the pool in order, keeping
+    at most window tasks submitted but not yet consumed so that the results
+    do not pile up in memory ahead of a slow consumer.
+    """
+
+    pending = collections.deque()
+    args = iter(args)
+
+    for arg in itertools.islice(args, window):
+        pending.append(pool.apply_async(func, (arg,)))
+
+    while pending:
+        result = pending.popleft().get()
+        for arg in itertools.islice(args, 1):
+            pending.append(pool.apply_async(func, (arg,)))
+        yield result
+
+
+def iter_extent_of_DEM(dem_name, crs_epsg, interval, processes=None,
+                       stripPoints=STRIP_POINTS):
+    """Yields the lon,lat tuples within the area covered by the DEM
+    (disregards NULL values) in the same order as get_extent_of_DEM.
+
+    The lon range is split into strips of columns which are evaluated in
+    worker processes. The valid points of each strip are yielded in order
+    as soon as the strip is done, and at most two strips per process are
+    evaluated ahead of the consumer so that the full list is never built.
+
+    :param dem_name: the path of the DEM
+    :param crs_epsg: the EPSG code of the coordinate reference system of the
+                     DEM (read from the DEM if None or blank)
+    :param interval: the interval between points to be downloaded (in degrees)
+    :param processes: the number of worker processes (defaults to the number
+                      of CPUs, 1 evaluates the strips in this process)
+    :param stripPoints: the approximate number of grid points per strip
+    :returns: a generator of lon,lat tuples
+    """
+
+    lons, lats, crs_epsg = get_extent_grid(dem_name, crs_epsg, interval)
+    if len(lons) == 0 or len(lats) == 0:
+        return
+
+    step = max(1, stripPoints // len(lats))
+    strips = [lons[x:x + step] for x in range(0, len(lons), step)]
+    initargs = (dem_name, crs_epsg, lats)
+
+    if processes == 1 or len(strips) == 1:
+        _init_extent_worker(*initargs)
+        results = (_extent_strip(strip) for strip in strips)
+        pool = None
+
+    else:
+        pool = multiprocessing.Pool(processes, _init_extent_worker, initargs)
+        results = _iter_bounded(pool, _extent_strip, strips,
+                                2 * (processes or multiprocessing.cpu_count()))
+
+    try:
+        for lon, lat in results:
+            for coord in zip(lon.tolist(), lat.tolist()):
+                yield coord
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _sniff_delimiter(sample):
+    """Returns the delimiter of a sample of a coordinate file or None if the
+    fields are separated by whitespace. Blank lines and lines starting with
+    '#' are left out of the sample.
+    """
+
+    sample = '\n'.join(line for line in sample.splitlines()
+                        if line.strip() and not line.lstrip().startswith('#'))
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=COORDS_DELIMITERS).delimiter
+    except csv.Error:
+        return None
+
+
+def _parse_coord(fields):
+    """Returns the first two fields of a row as floats or None if they are
+    not numbers.
+    """
+
+    try:
+        return float(fields[0]), float(fields[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def iter_coords_file(path, delimiter=None, header=None, crs_epsg=None,
+                     decimals=None, unique=False, chunkSize=COORDS_CHUNK):
+    """Yields the lon,lat tuples of a text file of coordinates.
+
+    The file is parsed in chunks of rows. Blank lines, lines starting with
+    '#' and the whitespace around the fields are ignored.
+
+    :param path: the path of the text file of x,y coordinates
+    :param delimiter: the field delimiter (detected from the file if None,
+                      falls back to whitespace)
+    :param header: True if the first row is a header, False if not, None to
+                   skip the first row if it is not numeric and has as many
+                   fields as the row after it
+    :param crs_epsg: the EPSG code of the coordinates (WGS84 if None)
+    :param decimals: the number of decimals to round the coordinates to
+    :param unique: skip the coordinates that were already yielded
+    :param chunkSize: the number of rows parsed at a time
+    :returns: a generator of lon,lat tuples
+    """
+
+    if crs_epsg not in (None, '', '4326', 4326):
+        crs = pyproj.Proj(init="epsg:%s" %crs_epsg)
+        wgs84 = pyproj.Proj(init="epsg:4326")
+    else:
+        crs = None
+
+    seen = set()
+    lineno = 0
+
+    with open(path, 'r') as f:
+        if delimiter is None:
+            delimiter = _sniff_delimiter(f.read(65536))
+            f.seek(0)
+
+        first = True
+        headerFields = None
+        while True:
+            lines = list(itertools.islice(f, chunkSize))
+            if not lines:
+                break
+
+            if delimiter is None:
+                rows = [line.split() for line in lines]
             else:
-                if data[py, px] == nodata:
-                    pass
+                rows = csv.reader(lines, delimiter=delimiter, skipinitialspace=True)
+
+            xs = []
+            ys = []
+            for fields in rows:
+                lineno += 1
+                if not fields or not fields[0].strip() or fields[0].lstrip().startswith('#'):
+                    continue
+
+                coord = _parse_coord(fields)
+                if first:
+                    first = False
+                    if header:
+                        continue
+                    if header is None and coord is None:
+                        headerFields = (lineno, len(fields))
+                        continue
 
-                else:
-                    coords.append((round(lon, 5), round(lat, 5)))
+                if headerFields is not None:
+                    # A row that does not match the layout of the data is not
+                    # a header but a row that could not be parsed
+                    if coord is not None and len(fields) != headerFields[1]:
+                        raise ValueError("Invalid coordinates on line %i of %s"
+                                         % (headerFields[0], path))
+                    headerFields = None
 
-            lat += interval
-        lon += interval
-        lat = latsouth
+                if coord is None:
+                    raise ValueError("Invalid coordinates on line %i of %s" % (lineno, path))
 
-    return coords
+                xs.append(coord[0])
+                ys.append(coord[1])
+
+            if not xs:
+                continue
+
+            lons = np.asarray(xs, dtype=np.float64)
+            lats = np.asarray(ys, dtype=np.float64)
+
+            if crs is not None:
+                lons, lats = pyproj.transform(crs, wgs84, lons, lats)
+                lons = np.asarray(lons, dtype=np.float64)
+                lats = np.asarray(lats, dtype=np.float64)
+
+            if decimals is not None:
+                lons = np.round(lons, decimals)
+                lats = np.round(lats, decimals)
+
+            for coord in zip(lons.tolist(), lats.tolist()):
+                if unique:
+                    if coord in seen:
+                        continue
+                    seen.add(coord)
+                yield coord
+
+
+def read_coords_file(path, **kwargs):
+    """Returns a list of the lon,lat tuples of a text file of coordinates.
+    Takes the same keyword arguments as iter_coords_file.
+    """
+
+    return list(iter_coords_file(path, **kwargs))
+
+
+def progressive_order(coords, interval):
+    """Returns the coordinates of a grid ordered coarse to fine: every 2^k-th
+    point of the grid in both directions first, then the points of every
+    2^(k-1)-th row and column that are not yet included, and so on. A run
+    stopped at any point then still covers the whole area uniformly.
+
+    The coordinates are built into a list to be reordered. Only points on a
+    regular grid (the DEM and bounding box options) can be ordered this way.
+
+    :param coords: an iterable of lon,lat tuples on a regular grid
+    :param interval: the interval between points of the grid (in degrees)
+    :returns: a list of lon,lat tuples
+    """
+
+    coords = list(coords)
+    if len(coords) < 2:
+        return coords
+
+    points = np.asarray(coords, dtype=np.float64)
+    lons = points[:, 0]
+    lats = points[:, 1]
+
+    step = float(interval)
+    i = np.rint((lons - lons.min()) / step).astype(np.int64)
+    j = np.rint((lats - lats.min()) / step).astype(np.int64)
+
+    top = int(np.floor(np.log2(max(int(i.max()), int(j.max()), 1))))
+
+    # The level of a point is the number of trailing zero bits shared by its
+    # column and row index, that is the coarsest stride it belongs to
+    both = i | j
+    lowest = both & -both
+    level = np.where(both == 0, top,
+                     np.minimum(np.log2(np.maximum(lowest, 1)).astype(np.int64), top))
+
+    order = np.lexsort((j, i, -level))
+
+    return [coords[x] for x in order]
 
 
 def get_linke_values(linke_table):
@@ -133,70 +505,960 @@ def get_linke_values(linke_table):
     return linkes[1:]
 
 
-def get_monthly_linke_str(linke_list):
+def get_monthly_linke_values(linke_list):
+    """Returns the 12 monthly Linke turbidity values of the SoDA result table
+    as floats or None if a month has no value.
+    """
 
-    linke = ''
-    for x in range(12):
-        linke += linke_list[x][1] + ","
+    try:
+        return [float(linke_list[x][1]) for x in range(12)]
+    except (IndexError, ValueError):
+        return None
 
-    return linke[:-1]
 
+def round_linke_values(values):
+    """Rounds Linke turbidity values half up to one decimal, the precision of
+    the SoDA webservice, so that 3.45 and 2.25 become 3.5 and 2.3. The small
+    offset keeps the binary error of values like 3.45 from rounding them down.
 
-def download_linke(coords, proxy, port, saveFile, saveMode):
+    :param values: a numpy array of Linke turbidity values
+    :returns: a numpy array of the rounded values
+    """
 
-    # print proxy,  port
-    # print proxy != ''
+    return np.floor((values * 10) + 0.5 + 1e-6) / 10
+
+
+def format_linkes(linkes):
+    """Returns the monthly Linke turbidity values as the comma-separated
+    string written to the output file.
+    """
+
+    return ",".join(format(v, '0.1f') for v in linkes)
+
+
+class LinkeResultBuffer(object):
+    """Keeps the downloaded points in a preallocated (size, 14) array of
+    LON, LAT, JAN to DEC and writes them to the output file in batches.
+    The buffer is flushed when it is full or when interval seconds have
+    passed since the last flush, so a crash loses at most one batch.
+    """
+
+    def __init__(self, f, size=FLUSH_SIZE, interval=FLUSH_INTERVAL):
+        """Initializes the buffer.
+        :param f: the open output file
+        :param size: the number of points kept before flushing
+        :param interval: the maximum number of seconds between flushes
+        """
+
+        self.f = f
+        self.rows = np.empty((size, 14), dtype=np.float64)
+        self.count = 0
+        self.interval = interval
+        self.last = time.time()
+
+    def append(self, lon, lat, linkes):
+        row = self.rows[self.count]
+        row[0] = lon
+        row[1] = lat
+        row[2:] = linkes
+        self.count += 1
+
+        if self.count == len(self.rows) or time.time() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered points to the output file.
+        :returns: the number of points written
+        """
+
+        count = self.count
+        if count:
+            np.savetxt(self.f, self.rows[:count], fmt=ROW_FORMAT, delimiter=',')
+            self.f.flush()
+
+        self.count = 0
+        self.last = time.time()
+
+        return count
+
+
+def load_downloaded_coords(saveFile):
+    """Returns a set of the lon,lat keys already present in an output file.
+
+    The keys are the '%0.5f' formatted strings written by download_linke so
+    that they can be compared against requested coordinates exactly.
+
+    :param saveFile: the path to an existing output .csv file
+    :returns: a set of (lon, lat) string tuples
+    """
+
+    done = set()
+    try:
+        with open(saveFile, 'r') as f:
+            for line in f:
+                cols = line.split(',', 2)
+                if len(cols) < 3:
+                    continue
+                done.add((cols[0].strip(), cols[1].strip()))
+
+    except IOError:
+        pass
+
+    return done
+
+
+def filter_downloaded(coords, done):
+    """Yields the coordinates that are not yet in the set of downloaded keys.
+
+    :param coords: an iterable of lon,lat tuples
+    :param done: a set of (lon, lat) string tuples from load_downloaded_coords
+    :returns: a generator of lon,lat tuples still to be downloaded
+    """
+
+    return (c for c in coords
+            if (format(c[0], '0.5f'), format(c[1], '0.5f')) not in done)
+
+
+def compact_linke_file(saveFile):
+    """Sorts an output file by lon,lat and removes duplicate points, keeping
+    the last row written for each point.
+
+    :param saveFile: the path to the output .csv file
+    :returns: the number of rows in the compacted file
+    """
+
+    rows = {}
+    with open(saveFile, 'r') as f:
+        for line in f:
+            cols = line.strip().split(',')
+            if len(cols) < 3:
+                continue
+            rows[(cols[0], cols[1])] = line.strip()
+
+    '''Write to a temporary file first so that a failed rewrite leaves
+    the original output intact.'''
+    keys = sorted(rows, key=lambda k: (float(k[0]), float(k[1])))
+    tmpFile = saveFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        for key in keys:
+            f.write(rows[key] + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(tmpFile, saveFile)
+
+    return len(keys)
+
+
+SODA_URL = ("http://www.soda-is.com/eng/services/service_invoke/gui.php?" +
+            "xml_descript=soda_tl.xml&Submit2=Month")
+
+# url = "http://www.soda-pro.com/web-services/atmosphere/turbidity-linke-2003"
+
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december']
+
+# The SoDA monthly Linke turbidity grids store TL multiplied by 20
+LINKE_GRID_SCALE = 0.05
+
+# The configured seconds per point of the SoDA webservice, used by
+# plan_download to estimate the runtime
+SODA_LATENCY = 2.0
+REQUEST_TIMEOUT = 60
+
+# The consecutive errors and average seconds per request that eject a proxy
+# and the seconds before an ejected proxy is tried again
+PROXY_MAX_ERRORS = 3
+PROXY_MAX_LATENCY = 30.0
+PROXY_RETRY_AFTER = 300
+
+
+def iter_batches(coords, size):
+    """Yields lists of at most size coordinates taken from coords.
+
+    :param coords: an iterable of lon,lat tuples
+    :param size: the maximum number of coordinates per batch
+    :returns: a generator of lists of lon,lat tuples
+    """
+
+    it = iter(coords)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_not_downloaded(path, coords, error=None):
+    """Writes the coordinates that were not downloaded to a text file that
+    can be used as the coordinates file of the next run. If the coordinates
+    after these could not be read, a '#' line with the error is written at
+    the end so that the file is not mistaken for the complete remainder.
+
+    :param path: the path of the text file
+    :param coords: an iterable of the lon,lat tuples not downloaded
+    :param error: the error that stopped the reading of the coordinates
+    """
+
+    with open(path, 'w') as nd:
+        try:
+            for c in coords:
+                nd.write("%s,%s\n" % (str(c[0]), str(c[1])))
+        except Exception as e:
+            error = e
+
+        if error is not None:
+            nd.write("# The coordinates after these could not be read: %s\n" % error)
+
+
+class LinkeProvider(object):
+    """The base class of the sources of Linke turbidity values used by
+    download_linke. A provider returns the 12 monthly values of a point as
+    a sequence of floats (JAN to DEC).
+    """
 
-    url = ("http://www.soda-is.com/eng/services/service_invoke/gui.php?" +
-           "xml_descript=soda_tl.xml&Submit2=Month")
+    # The number of coordinates download_linke passes to fetch at a time
+    batchSize = 1
 
-    # url = "http://www.soda-pro.com/web-services/atmosphere/turbidity-linke-2003"
+    # The expected seconds per point and number of points fetched at a time,
+    # used by plan_download to estimate the runtime
+    latency = 0.0
+    concurrency = 1
 
-    session = Session()
-    session.verify = False
+    def fetch(self, coords):
+        """Yields a (lon, lat, linkes) tuple for each coordinate in order.
 
-    if proxy != '':
-        proxies = {proxy: port}
-        session.proxies = proxies
+        :param coords: a list of lon,lat tuples
+        :returns: a generator of (lon, lat, linkes) tuples where linkes is
+                  the sequence of the 12 monthly values or None if the point
+                  has no values
+        """
+        raise NotImplementedError
 
-    br = RoboBrowser(session=session, parser="lxml")
-    br.open(url)
+    def report(self):
+        """Returns a readable summary of the provider's statistics, if any"""
+        return ''
 
-    linke_form = br.get_forms()[1]
+    def close(self):
+        """Releases the resources held by the provider"""
+        pass
+
+
+def parse_proxies(proxy, port=''):
+    """Returns the list of proxy urls of a comma-separated list of proxies.
+
+    :param proxy: the proxy servers as 'host' or 'host:port' separated by
+                  commas (if any)
+    :param port: the port of the proxies given without one
+    :returns: a list of 'http://host:port' urls
+    """
+
+    urls = []
+    for p in proxy.split(','):
+        p = p.strip()
+        if p == '':
+            continue
+        if '://' not in p:
+            p = 'http://' + p
+        if port != '' and p.count(':') < 2:
+            p = '%s:%s' % (p, port)
+        urls.append(p)
+
+    return urls
+
+
+class ProxyState(object):
+    """The health and latency statistics of one egress proxy of a ProxyPool"""
+
+    def __init__(self, url):
+        """Initializes the statistics.
+        :param url: the proxy url or None to connect directly
+        """
+
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutiveErrors = 0
+        self.totalTime = 0.0
+        self.latency = None
+        self.ejected = None
+        self.probation = False
+        self.browsers = []
+
+    def stats(self):
+        return {'proxy': self.url or 'direct',
+                'requests': self.requests,
+                'errors': self.errors,
+                'success': (1.0 - float(self.errors) / self.requests) if self.requests else None,
+                'latency': self.latency,
+                'mean_latency': (self.totalTime / self.requests) if self.requests else None,
+                'outstanding': self.outstanding,
+                'ejected': self.ejected is not None}
+
+
+class ProxyPool(object):
+    """Balances requests across several proxies. A proxy that fails
+    maxErrors times in a row or whose average latency goes above maxLatency
+    is ejected. After retryAfter seconds it is put on probation: it gets one
+    request at a time and is ejected again by its first failure. When no
+    proxy is available, acquire waits for one instead of failing.
+    """
+
+    def __init__(self, proxies, policy='least', maxErrors=PROXY_MAX_ERRORS,
+                 maxLatency=PROXY_MAX_LATENCY, retryAfter=PROXY_RETRY_AFTER):
+        """Initializes the pool.
+        :param proxies: a list of proxy urls, empty to connect directly
+        :param policy: 'least' to pick the proxy with the least outstanding
+                       requests or 'roundrobin' to take turns
+        :param maxErrors: the consecutive errors that eject a proxy
+        :param maxLatency: the average seconds per request that eject a proxy
+        :param retryAfter: the seconds before an ejected proxy is tried again
+        """
+
+        if policy not in ('least', 'roundrobin'):
+            raise ValueError("Unknown proxy policy: %s" % policy)
+
+        self.states = [ProxyState(url) for url in proxies] or [ProxyState(None)]
+        self.policy = policy
+        self.maxErrors = maxErrors
+        self.maxLatency = maxLatency
+        self.retryAfter = retryAfter
+        self.lock = threading.Condition()
+        self.turn = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def healthy(self):
+        """Returns the number of proxies that are not ejected"""
+        with self.lock:
+            return len([p for p in self.states if p.ejected is None])
+
+    def acquire(self, exclude=(), timeout=None):
+        """Returns the healthy proxy to send the next request through. If
+        every proxy is ejected or on probation with a request outstanding,
+        waits until a request is released or an ejected proxy is due a retry.
+
+        :param exclude: the proxies not to pick, if others are available
+        :param timeout: the maximum seconds to wait (no limit if None)
+        :returns: a ProxyState
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.lock:
+            while True:
+                now = time.time()
+                healthy = [p for p in self.states
+                           if (p.ejected is None and not (p.probation and p.outstanding)) or
+                           (p.ejected is not None and now - p.ejected >= self.retryAfter)]
+                if healthy:
+                    break
+
+                due = [p.ejected + self.retryAfter - now
+                       for p in self.states if p.ejected is not None]
+                wait = min(due) if due else None
+                if deadline is not None:
+                    if now >= deadline:
+                        raise IOError("No proxy became available in %i seconds" % timeout)
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+
+                self.lock.wait(wait)
+
+            candidates = [p for p in healthy if p not in exclude] or healthy
+
+            if self.policy == 'roundrobin':
+                state = candidates[self.turn % len(candidates)]
+                self.turn += 1
+            else:
+                state = min(candidates, key=lambda p: (p.outstanding, p.requests))
+
+            if state.ejected is not None:
+                state.ejected = None
+                state.probation = True
+
+            state.outstanding += 1
+            return state
+
+    def release(self, state, seconds, ok):
+        """Records the result of a request sent through a proxy.
+
+        :param state: the ProxyState from acquire
+        :param seconds: the duration of the request
+        :param ok: False if the request failed
+        """
+
+        with self.lock:
+            state.outstanding -= 1
+            state.requests += 1
+            state.totalTime += seconds
+
+            if state.latency is None:
+                state.latency = seconds
+            else:
+                state.latency = 0.8 * state.latency + 0.2 * seconds
+
+            if ok:
+                state.consecutiveErrors = 0
+                state.ejected = None
+            else:
+                state.errors += 1
+                state.consecutiveErrors += 1
+
+            if ((not ok and state.probation) or
+                    state.consecutiveErrors >= self.maxErrors or
+                    state.latency > self.maxLatency):
+                state.ejected = time.time()
+                state.consecutiveErrors = 0
+                state.latency = None
+                del state.browsers[:]
+
+            elif ok:
+                state.probation = False
+
+            self.lock.notify_all()
+
+    def eject(self, state):
+        with self.lock:
+            state.ejected = time.time()
+            del state.browsers[:]
+            self.lock.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return [p.stats() for p in self.states]
+
+    def report(self):
+        """Returns a readable summary of the statistics of the proxies"""
+
+        lines = []
+        for st in self.stats():
+            line = "%s: %i requests, %i errors" % (st['proxy'], st['requests'], st['errors'])
+            if st['mean_latency'] is not None:
+                line += ", %0.2f s per request" % st['mean_latency']
+            if st['ejected']:
+                line += ", ejected"
+            lines.append(line)
+
+        return "\n".join(lines)
+
+
+class SodaWebProvider(LinkeProvider):
+    """Scrapes the Linke turbidity values point by point from the SoDA
+    webservice form. With several proxies, points are downloaded through
+    all of them at once, balanced by a ProxyPool.
+    """
+
+    batchSize = 100
+    latency = SODA_LATENCY
+
+    def __init__(self, proxy='', port='', url=SODA_URL, policy='least',
+                 timeout=REQUEST_TIMEOUT):
+        """Opens the SoDA Linke turbidity form through each proxy.
+        :param proxy: the proxy servers separated by commas (if any)
+        :param port: the port of the proxies given without one
+        :param url: the url of the SoDA Linke turbidity form
+        :param policy: the ProxyPool policy, 'least' or 'roundrobin'
+        :param timeout: the seconds before a request is abandoned
+        """
+
+        self.url = url
+        self.timeout = timeout
+        self.proxies = ProxyPool(parse_proxies(proxy, port), policy)
+        self.threads = None
+
+        self.check()
+        self.concurrency = self.proxies.healthy()
+
+        if self.concurrency > 1:
+            self.threads = ThreadPool(self.concurrency)
+
+    def open_browser(self, state):
+        """Returns a RoboBrowser and the Linke turbidity form opened through
+        a proxy.
+        """
+
+        session = Session()
+        session.verify = False
+
+        if state.url is not None:
+            session.proxies = {'http': state.url, 'https': state.url}
+
+        br = RoboBrowser(session=session, parser="lxml", timeout=self.timeout)
+        br.open(self.url)
+
+        return br, br.get_forms()[1]
+
+    def check(self):
+        """Opens the form through each proxy and ejects the proxies that
+        fail. The opened forms are kept for the downloads.
+        """
+
+        for state in self.proxies.states:
+            start = time.time()
+            try:
+                state.browsers.append(self.open_browser(state))
+            except Exception as e:
+                print "Proxy %s failed the health check: %s" % (state.url or 'direct', e)
+                self.proxies.eject(state)
+            else:
+                state.latency = time.time() - start
+
+        if all(p.ejected is not None for p in self.proxies.states):
+            raise IOError("Cannot open %s through any proxy" % self.url)
+
+    def fetch_one(self, coord):
+        """Returns the (lon, lat, linkes) of a point, retrying on the other
+        proxies if one fails.
+        """
+
+        tried = []
+        error = None
+        for attempt in range(len(self.proxies) + 1):
+            state = self.proxies.acquire(tried, self.proxies.retryAfter + self.timeout)
+            tried.append(state)
+            start = time.time()
+            try:
+                try:
+                    br, linke_form = state.browsers.pop()
+                except IndexError:
+                    br, linke_form = self.open_browser(state)
+
+                linkes = self.submit(br, linke_form, coord)
+
+            except Exception as e:
+                error = e
+                self.proxies.release(state, time.time() - start, False)
+
+            else:
+                state.browsers.append((br, linke_form))
+                self.proxies.release(state, time.time() - start, True)
+                return coord[0], coord[1], linkes
+
+        raise error
+
+    def submit(self, br, linke_form, coord):
+        inlon, inlat = coord
+        linke_form['lat'].value = inlat
+        linke_form['lon'].value = inlon
+
+        sf = linke_form.submit_fields.getlist('execute')
+        br.submit_form(linke_form, submit=sf[0])
+
+        linke_table = br.find("table",
+                              {"cellspacing": "0", "cellpadding": "2"})
+
+        linkes = get_monthly_linke_values(get_linke_values(linke_table))
+
+        br.back()
+
+        return linkes
+
+    def fetch(self, coords):
+        if self.threads is None:
+            return (self.fetch_one(coord) for coord in coords)
+
+        return self.threads.imap(self.fetch_one, coords)
+
+    def report(self):
+        return self.proxies.report()
+
+    def close(self):
+        if self.threads is not None:
+            self.threads.terminate()
+            self.threads = None
+
+
+class LocalRasterProvider(LinkeProvider):
+    """Samples the Linke turbidity values from the 12 monthly global grids
+    distributed by SoDA. All the coordinates of a batch are sampled with one
+    windowed read per month.
+
+    The grids have a precision of 0.05 but the values are rounded half up to
+    one decimal like the ones of the SoDA webservice, so that both write the
+    same output.
+    """
+
+    batchSize = 100000
+    latency = 0.0001
+
+    def __init__(self, grids, scale=LINKE_GRID_SCALE):
+        """Opens the monthly grids.
+        :param grids: a list of the paths of the 12 monthly grids (JAN to DEC)
+                      in the WGS84 coordinate system
+        :param scale: the factor that converts the grid values to TL
+        """
+
+        if len(grids) != 12:
+            raise ValueError("Expected 12 monthly grids, got %i" % len(grids))
+
+        gdal.AllRegister()
+        self.grids = [gdal.Open(g, GA_ReadOnly) for g in grids]
+        self.scale = scale
+
+    def sample(self, lons, lats):
+        """Returns the monthly Linke turbidity values of the coordinates.
+
+        :param lons: a numpy array of longitudes
+        :param lats: a numpy array of latitudes
+        :returns: a (N, 12) numpy array of the values rounded to one decimal
+                  with NaN where a grid has no value
+        """
+
+        values = np.empty((len(lons), 12), dtype=np.float64)
+        values.fill(np.nan)
+
+        for month, grid in enumerate(self.grids):
+            gtf = grid.GetGeoTransform()
+            band = grid.GetRasterBand(1)
+            nodata = band.GetNoDataValue()
+
+            px, py = map_to_pixel(gtf, lons, lats)
+
+            inside = ((px >= 0) & (py >= 0) &
+                      (px < grid.RasterXSize) & (py < grid.RasterYSize))
+            if not inside.any():
+                continue
+
+            px = px[inside]
+            py = py[inside]
+            xoff = int(px.min())
+            yoff = int(py.min())
+            data = band.ReadAsArray(xoff, yoff,
+                                    int(px.max()) - xoff + 1,
+                                    int(py.max()) - yoff + 1)
+
+            sampled = data[py - yoff, px - xoff].astype(np.float64)
+            if nodata is not None:
+                sampled[sampled == nodata] = np.nan
+
+            values[inside, month] = sampled * self.scale
+
+        return round_linke_values(values)
+
+    def fetch(self, coords):
+        points = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        values = self.sample(points[:, 0], points[:, 1])
+
+        for (inlon, inlat), row in zip(coords, values):
+            if np.isnan(row).any():
+                yield inlon, inlat, None
+            else:
+                yield inlon, inlat, row
+
+    def close(self):
+        self.grids = []
+
+
+def find_monthly_grids(directory):
+    """Returns the paths of the 12 monthly Linke turbidity grids (JAN to DEC)
+    in a directory. The grids are matched by the month name or abbreviation
+    in their file names, otherwise by the month number (1 or 01 to 12) that
+    ends their file names, e.g. TL_1.tif to TL_12.tif.
+
+    :param directory: the directory containing the monthly grids
+    :returns: a list of the paths of the 12 monthly grids
+    """
+
+    names = sorted(n for n in os.listdir(directory)
+                   if os.path.splitext(n)[1].lower() in ('.tif', '.tiff'))
+
+    grids = []
+    for month in MONTHS:
+        matches = [n for n in names if month in n.lower()]
+        if not matches:
+            matches = [n for n in names if month[:3] in n.lower()]
+        if len(matches) != 1:
+            break
+        grids.append(os.path.join(directory, matches[0]))
+
+    if len(grids) == 12:
+        return grids
+
+    months = {}
+    for n in names:
+        number = re.search(r'(\d+)\D*$', os.path.splitext(n)[0])
+        if number is None:
+            continue
+        month = int(number.group(1))
+        if 1 <= month <= 12:
+            if month in months:
+                raise ValueError("Both %s and %s look like month %i in %s"
+                                 % (months[month], n, month, directory))
+            months[month] = n
+
+    if len(months) != 12:
+        raise ValueError("Cannot find the 12 monthly grids in %s, name them by "
+                         "month name or number (01 to 12)" % directory)
+
+    return [os.path.join(directory, months[m]) for m in range(1, 13)]
+
+
+def iter_bbox_coords(west, east, south, north, interval):
+    """Yields the lon,lat tuples of the grid of a bounding box.
+
+    :param west: the longitude of the west edge
+    :param east: the longitude of the east edge
+    :param south: the latitude of the south edge
+    :param north: the latitude of the north edge
+    :param interval: the interval between points (in degrees)
+    :returns: a generator of lon,lat tuples
+    """
+
+    for x in range(int((east - west) / interval) + 1):
+        for y in range(int((north - south) / interval) + 1):
+            yield (west + (x * interval), south + (y * interval))
+
+
+def count_bbox_coords(west, east, south, north, interval):
+    """Returns the number of points iter_bbox_coords yields"""
+
+    return ((int((east - west) / interval) + 1) *
+            (int((north - south) / interval) + 1))
+
+
+def get_coords_bounds(coords):
+    """Returns the number of coordinates and their (west, east, south, north)
+    extent, consuming them in chunks.
+
+    :param coords: an iterable of lon,lat tuples
+    :returns: a tuple of the count and the extent (None if there are none)
+    """
+
+    count = 0
+    west = south = float('inf')
+    east = north = float('-inf')
+
+    for batch in iter_batches(coords, COORDS_CHUNK):
+        points = np.asarray(batch, dtype=np.float64).reshape(-1, 2)
+        count += len(points)
+        west = min(west, points[:, 0].min())
+        east = max(east, points[:, 0].max())
+        south = min(south, points[:, 1].min())
+        north = max(north, points[:, 1].max())
+
+    if not count:
+        return 0, None
+
+    return count, (west, east, south, north)
+
+
+class CoveragePreview(object):
+    """A low resolution raster of the cells of an extent that have points.
+    Points are added in chunks so that they never need to be kept.
+    """
+
+    def __init__(self, bounds, size=PREVIEW_SIZE):
+        """Initializes an empty preview.
+        :param bounds: the (west, east, south, north) extent of the preview
+        :param size: the size in pixels of the longer side of the preview
+        """
+
+        west, east, south, north = bounds
+        width = max(east - west, 1e-9)
+        height = max(north - south, 1e-9)
+
+        self.west = west
+        self.north = north
+        self.cell = max(width, height) / size
+        self.cols = max(1, int(np.ceil(width / self.cell)))
+        self.rows = max(1, int(np.ceil(height / self.cell)))
+        self.coverage = np.zeros((self.rows, self.cols), dtype=np.uint8)
+
+    def add(self, points):
+        """Marks the cells of a (N, 2) array of lon,lat as covered"""
+
+        px = np.clip(((points[:, 0] - self.west) / self.cell).astype(np.int64),
+                     0, self.cols - 1)
+        py = np.clip(((self.north - points[:, 1]) / self.cell).astype(np.int64),
+                     0, self.rows - 1)
+        self.coverage[py, px] = 255
+
+    def fill(self):
+        """Marks the whole extent as covered"""
+
+        self.coverage.fill(255)
+
+    def write(self, preview):
+        """Writes the preview to an image (.png or .tif)"""
+
+        gdal.AllRegister()
+        mem = gdal.GetDriverByName('MEM').Create('', self.cols, self.rows, 1, GDT_Byte)
+        mem.SetGeoTransform((self.west, self.cell, 0.0, self.north, 0.0, -self.cell))
+        mem.GetRasterBand(1).WriteArray(self.coverage)
+
+        if os.path.splitext(preview)[1].lower() == '.png':
+            driver = gdal.GetDriverByName('PNG')
+        else:
+            driver = gdal.GetDriverByName('GTiff')
+        driver.CreateCopy(preview, mem)
+
+
+def plan_download(coords, latency=SODA_LATENCY, concurrency=1, preview=None,
+                  bounds=None, count=None, previewSize=PREVIEW_SIZE):
+    """Counts the points of a download and estimates its runtime without
+    downloading anything. The coordinates are consumed in chunks so that an
+    iterable like iter_extent_of_DEM is never built into a list, and are
+    not consumed at all if the count is known and no preview is written.
+
+    :param coords: an iterable of lon,lat tuples or None if the count is
+                   given and the points fill the bounds, like a bounding box
+    :param latency: the seconds per point
+    :param concurrency: the number of points downloaded at a time
+    :param preview: the path of a low resolution coverage image (.png or
+                    .tif) to write, if any
+    :param bounds: the (west, east, south, north) extent of the points,
+                   needed for the preview (see get_coords_bounds)
+    :param count: the number of points if already known
+    :param previewSize: the size in pixels of the longer side of the preview
+    :returns: a dict of the number of 'points', the estimated 'seconds',
+              the 'latency', 'concurrency', 'bounds' and 'preview'
+    """
+
+    coverage = None
+    if preview is not None:
+        if bounds is None:
+            raise ValueError("The extent of the points is needed for the preview")
+        coverage = CoveragePreview(bounds, previewSize)
+
+    if coords is None:
+        if coverage is not None:
+            coverage.fill()
+
+    elif count is None or coverage is not None:
+        counted = 0
+        for batch in iter_batches(coords, COORDS_CHUNK):
+            counted += len(batch)
+            if coverage is not None:
+                coverage.add(np.asarray(batch, dtype=np.float64).reshape(-1, 2))
+        count = counted
+
+    if coverage is not None and count:
+        coverage.write(preview)
+
+    return {'points': count,
+            'latency': latency,
+            'concurrency': concurrency,
+            'seconds': count * latency / max(concurrency, 1),
+            'bounds': bounds,
+            'preview': preview if coverage is not None and count else None}
+
+
+def format_plan(plan):
+    """Returns a readable summary of a plan from plan_download"""
+
+    minutes, seconds = divmod(int(plan['seconds']), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    lines = ["Points: %i" % plan['points'],
+             "Seconds per point: %g" % plan['latency'],
+             "Concurrent downloads: %i" % plan['concurrency'],
+             "Estimated runtime: %ih %02im %02is" % (hours, minutes, seconds)]
+    if plan['bounds'] is not None:
+        lines.append("Extent: W %0.5f, E %0.5f, S %0.5f, N %0.5f" % tuple(plan['bounds']))
+    if plan['preview'] is not None:
+        lines.append("Coverage preview: %s" % plan['preview'])
+
+    return "\n".join(lines)
+
+
+def download_linke(coords, proxy, port, saveFile, saveMode, compact=False,
+                   provider=None):
+    """Downloads the Linke turbidity values of the coordinates into saveFile.
+
+    :param coords: a list or an iterable of lon,lat tuples
+    :param proxy: the proxy servers separated by commas (if any)
+    :param port: the port of the proxies given without one
+    :param saveFile: the output .csv file
+    :param saveMode: 'w' to overwrite, 'a' to append or 'i' to append only
+                     the coordinates not yet in saveFile
+    :param compact: sort and remove duplicate points from saveFile when done
+    :param provider: the LinkeProvider to get the values from (defaults to
+                     the SoDA webservice through the proxy)
+
+    The coordinates are read as they are downloaded, so an invalid line of a
+    coordinates file only stops the download when it is reached. PLAN reads
+    all of them first and is the way to check the file before a long run.
+    """
+
+    # print proxy,  port
+    # print proxy != ''
+
+    try:
+        num = str(len(coords))
+    except TypeError:
+        num = '?'
+
+    if saveMode == 'i':
+        done = load_downloaded_coords(saveFile)
+        coords = filter_downloaded(coords, done)
+        num = '?'
+        saveMode = 'a'
+        print "%s already has %i points, the requested points among them are skipped" % (saveFile, len(done))
+
+    if provider is None:
+        provider = SodaWebProvider(proxy, port)
 
-    num = len(coords)
     index = 0
+    remaining = iter(coords)
+    batch = []
+    fetched = 0
+    sourceError = None
+    lastProgress = 0.0
 
     with open(saveFile, saveMode) as f:
+        results = LinkeResultBuffer(f)
         try:
-            for coord in coords:
-                inlon, inlat = coord
-                linke_form['lat'].value = inlat
-                linke_form['lon'].value = inlon
+            while sourceError is None:
+                # The batch is filled one point at a time so that the points
+                # read before the coordinates fail are still downloaded
+                batch = []
+                fetched = 0
+                try:
+                    for coord in itertools.islice(remaining, provider.batchSize):
+                        batch.append(coord)
+                except Exception as e:
+                    sourceError = e
 
-                sf = linke_form.submit_fields.getlist('execute')
-                br.submit_form(linke_form, submit=sf[0])
+                if not batch:
+                    break
 
-                linke_table = br.find("table",
-                                      {"cellspacing": "0", "cellpadding": "2"})
+                for inlon, inlat, linkes in provider.fetch(batch):
+                    fetched += 1
 
-                linkes = get_monthly_linke_str(get_linke_values(linke_table))
-                s = "%s,%s,%s\n" % (format(inlon, '0.5f'), format(inlat, '0.5f'), linkes)
+                    if linkes is not None:
+                        results.append(inlon, inlat, linkes)
 
-                if len(s) > 48:
-                    f.write(s)
-                    print "Done with point %i of %i: (%s, %s)" % (index + 1, num, format(inlon, '0.5f'), format(inlat, '0.5f'))
+                    if time.time() - lastProgress >= PROGRESS_INTERVAL:
+                        lastProgress = time.time()
+                        print "Done with point %i of %s: (%s, %s)" % (index + fetched, num, format(inlon, '0.5f'), format(inlat, '0.5f'))
 
-                index += 1
+                index += fetched
 
-                br.back()
+            results.flush()
 
-            print "DONE!"
+            if sourceError is None:
+                print "DONE!"
+            else:
+                write_not_downloaded(saveFile + "_notdownloaded.txt", [], sourceError)
+                print "Could not read the coordinates after point %i: %s" % (index, sourceError)
 
         except Exception as e:
 
-            not_dl = list(coords[index:])
-            with open(saveFile + "_notdownloaded.txt", "w") as nd:
-                for c in not_dl:
-                    nd.write("%s,%s\n" % (str(c[0]), str(c[1])))
+            not_dl = batch[fetched:]
+            if sourceError is None:
+                not_dl = itertools.chain(not_dl, remaining)
+            write_not_downloaded(saveFile + "_notdownloaded.txt", not_dl, sourceError)
             print e
+
+        finally:
+            results.flush()
+            provider.close()
+
+            report = provider.report()
+            if report:
+                print report
+
+    if compact:
+        print "Compacted %s to %i points" % (saveFile, compact_linke_file(saveFile))
@@ -0,0 +1,245 @@
+"""
+Unit tests of the single-flight, LRU cache and store logic of the local
+Linke turbidity lookup service.
+
+To run the tests, go to the directory and type:
+python -m unittest test_solar_download_linke_server
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import solar_download_linke_server as server
+
+
+LINKES = [3.4, 3.4, 3.9, 4.3, 4.3, 4.5, 4.6, 4.6, 4.5, 4.0, 3.6, 3.7]
+LINKES_STR = "3.4,3.4,3.9,4.3,4.3,4.5,4.6,4.6,4.5,4.0,3.6,3.7"
+
+
+class FakeProvider(object):
+    """A LinkeProvider that records the points it is asked for"""
+
+    batchSize = 100
+
+    def __init__(self, fail=None, gate=None, missing=(), delay=0):
+        """
+        :param fail: the number of points to return before raising
+        :param gate: an Event to wait on before fetching
+        :param missing: the lon,lat tuples that have no values
+        :param delay: the seconds taken to fetch each point
+        """
+        self.calls = []
+        self.fail = fail
+        self.gate = gate
+        self.missing = set(missing)
+        self.delay = delay
+        self.closed = False
+
+    def fetch(self, coords):
+        self.calls.append(list(coords))
+        if self.gate is not None:
+            self.gate.wait(10)
+
+        for index, (lon, lat) in enumerate(coords):
+            if self.fail is not None and index >= self.fail:
+                raise IOError("upstream failed")
+            time.sleep(self.delay)
+            if (lon, lat) in self.missing:
+                yield lon, lat, None
+            else:
+                yield lon, lat, LINKES
+
+    def close(self):
+        self.closed = True
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = server.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+
+class LinkeServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = server.LinkeStore(os.path.join(self.tmp, 'store.sqlite'))
+        self.providers = []
+        self.flightTimeout = server.FLIGHT_TIMEOUT
+
+    def tearDown(self):
+        server.FLIGHT_TIMEOUT = self.flightTimeout
+        self.store.close()
+        shutil.rmtree(self.tmp)
+
+    def wait_for_stat(self, service, name, value):
+        while service.get_stats().get(name, 0) < value:
+            time.sleep(0.01)
+
+    def make_service(self, *providers, **kwargs):
+        """Returns a LinkeService whose factory hands out the providers in turn"""
+        self.providers = list(providers)
+        queue = list(providers)
+        return server.LinkeService(lambda: queue.pop(0), self.store, **kwargs)
+
+    def test_lookup_fetches_persists_and_caches(self):
+        provider = FakeProvider()
+        service = self.make_service(provider)
+
+        first = service.lookup([(121.0, 14.0)])
+        second = service.lookup([(121.0, 14.0)])
+
+        self.assertEqual(first, [('121.00000', '14.00000', LINKES_STR, None)])
+        self.assertEqual(second, first)
+        self.assertEqual(len(provider.calls), 1)
+        self.assertEqual(self.store.get(('121.00000', '14.00000')), LINKES_STR)
+        self.assertEqual(service.get_stats()['cache_hits'], 1)
+
+    def test_store_hit_skips_provider(self):
+        self.store.put(('121.00000', '14.00000'), LINKES_STR)
+        provider = FakeProvider()
+        service = self.make_service(provider)
+
+        result = service.lookup([(121.0, 14.0)])
+
+        self.assertEqual(result[0][2], LINKES_STR)
+        self.assertEqual(provider.calls, [])
+        self.assertEqual(service.get_stats()['store_hits'], 1)
+
+    def test_duplicate_points_in_a_batch_are_fetched_once(self):
+        provider = FakeProvider()
+        service = self.make_service(provider)
+
+        result = service.lookup([(121.0, 14.0), (121.0, 14.0), (121.25, 14.0)])
+
+        self.assertEqual(len(result), 3)
+        self.assertEqual(provider.calls, [[(121.0, 14.0), (121.25, 14.0)]])
+
+    def test_concurrent_lookups_share_one_upstream_request(self):
+        gate = threading.Event()
+        provider = FakeProvider(gate=gate)
+        service = self.make_service(provider)
+        results = []
+
+        def lookup():
+            results.append(service.lookup([(121.0, 14.0)]))
+
+        threads = [threading.Thread(target=lookup) for _ in range(5)]
+        for t in threads:
+            t.start()
+
+        while service.get_stats().get('coalesced', 0) < 4:
+            threading.Event().wait(0.01)
+        gate.set()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(provider.calls), 1)
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertEqual(result[0][2], LINKES_STR)
+        self.assertEqual(service.get_stats()['in_flight'], 0)
+
+    def test_large_batches_are_fetched_in_provider_batches(self):
+        provider = FakeProvider()
+        provider.batchSize = 2
+        service = self.make_service(provider)
+
+        service.lookup([(121.0 + x, 14.0) for x in range(5)])
+
+        self.assertEqual([len(c) for c in provider.calls], [2, 2, 1])
+
+    def test_failure_only_fails_unresolved_points(self):
+        failing = FakeProvider(fail=1)
+        service = self.make_service(failing, FakeProvider())
+
+        result = service.lookup([(121.0, 14.0), (121.25, 14.0)])
+
+        self.assertEqual(result[0][2:], (LINKES_STR, None))
+        self.assertIsNone(result[1][2])
+        self.assertEqual(result[1][3], 'upstream failed')
+        self.assertTrue(failing.closed)
+        self.assertEqual(service.get_stats()['in_flight'], 0)
+
+        retry = service.lookup([(121.25, 14.0)])
+
+        self.assertEqual(retry[0][2], LINKES_STR)
+        self.assertEqual(len(self.providers[1].calls), 1)
+
+    def test_points_without_values_are_not_cached(self):
+        provider = FakeProvider(missing=[(121.0, 14.0)])
+        service = self.make_service(provider)
+
+        service.lookup([(121.0, 14.0)])
+        result = service.lookup([(121.0, 14.0)])
+
+        self.assertEqual(result, [('121.00000', '14.00000', None, None)])
+        self.assertEqual(len(provider.calls), 2)
+        self.assertIsNone(self.store.get(('121.00000', '14.00000')))
+
+    def test_stale_failure_leaves_newer_flight_alone(self):
+        service = self.make_service(FakeProvider())
+        stale = server._Flight()
+        newer = server._Flight()
+        key = ('121.00000', '14.00000')
+        service.flights[key] = newer
+
+        service._finish(key, stale, None, 'upstream failed')
+
+        self.assertIs(service.flights[key], newer)
+        self.assertFalse(newer.event.is_set())
+        self.assertTrue(stale.event.is_set())
+
+    def test_waiters_keep_waiting_while_the_leader_progresses(self):
+        server.FLIGHT_TIMEOUT = 0.3
+        provider = FakeProvider(delay=0.1)
+        provider.batchSize = 1
+        service = self.make_service(provider)
+        coords = [(121.0 + x, 14.0) for x in range(8)]
+
+        leader = threading.Thread(target=service.lookup, args=(coords,))
+        leader.start()
+        self.wait_for_stat(service, 'upstream', 1)
+
+        result = service.lookup([coords[-1]])
+        leader.join()
+
+        self.assertEqual(result[0][2:], (LINKES_STR, None))
+        self.assertEqual(service.get_stats().get('timeouts', 0), 0)
+
+    def test_stalled_flight_times_out_and_is_released(self):
+        server.FLIGHT_TIMEOUT = 0.2
+        gate = threading.Event()
+        service = self.make_service(FakeProvider(gate=gate))
+
+        leader = threading.Thread(target=service.lookup, args=([(121.0, 14.0)],))
+        leader.start()
+        self.wait_for_stat(service, 'in_flight', 1)
+
+        started = time.time()
+        result = service.lookup([(121.0, 14.0)])
+
+        self.assertEqual(result[0][2:], (None, 'timed out'))
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual(service.get_stats()['in_flight'], 0)
+
+        gate.set()
+        leader.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
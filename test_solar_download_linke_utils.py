@@ -0,0 +1,347 @@
+"""
+Unit tests of the coordinate, ordering, save file and proxy helpers of the
+Download Linke Turbidity Coefficient Tool.
+
+To run the tests, go to the directory and type:
+python -m unittest test_solar_download_linke_utils
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+import solar_download_linke_utils as utils
+
+
+LINKES = [3.4, 3.4, 3.9, 4.3, 4.3, 4.5, 4.6, 4.6, 4.5, 4.0, 3.6, 3.7]
+
+
+class FakeProvider(utils.LinkeProvider):
+    """A LinkeProvider that fails after returning a number of points"""
+
+    def __init__(self, batchSize=3, fail=None, linkes=LINKES):
+        self.batchSize = batchSize
+        self.fail = fail
+        self.linkes = linkes
+        self.fetched = 0
+        self.coords = []
+
+    def fetch(self, coords):
+        for lon, lat in coords:
+            if self.fail is not None and self.fetched >= self.fail:
+                raise IOError("upstream failed")
+            self.fetched += 1
+            self.coords.append((lon, lat))
+            yield lon, lat, self.linkes
+
+
+def failing_coords(count):
+    """Yields count points and then fails like an invalid coordinates file"""
+
+    for x in range(count):
+        yield (121.0 + x, 14.0)
+    raise ValueError("Invalid coordinates on line %i" % (count + 1))
+
+
+class RoundLinkeValuesTest(unittest.TestCase):
+
+    def test_rounds_half_up_to_one_decimal(self):
+        grid = np.array([69, 45, 68, 70, 61]) * utils.LINKE_GRID_SCALE
+
+        self.assertEqual(utils.round_linke_values(grid).tolist(),
+                         [3.5, 2.3, 3.4, 3.5, 3.1])
+
+    def test_nan_is_kept(self):
+        values = utils.round_linke_values(np.array([float('nan'), 3.44]))
+
+        self.assertTrue(np.isnan(values[0]))
+        self.assertEqual(values[1], 3.4)
+
+
+class ProgressiveOrderTest(unittest.TestCase):
+
+    def stride(self, i, j, top):
+        """Returns the coarsest power-of-two stride a grid index belongs to"""
+
+        stride = 1
+        while stride < top and i % (stride * 2) == 0 and j % (stride * 2) == 0:
+            stride *= 2
+        return stride
+
+    def test_orders_a_grid_level_by_level(self):
+        coords = [(121.0 + (i * 0.25), 14.0 + (j * 0.25))
+                  for i in range(9) for j in range(9)]
+
+        ordered = utils.progressive_order(coords, 0.25)
+
+        self.assertEqual(sorted(ordered), sorted(coords))
+
+        indexes = [(int(round((lon - 121.0) / 0.25)), int(round((lat - 14.0) / 0.25)))
+                   for lon, lat in ordered]
+        strides = [self.stride(i, j, 8) for i, j in indexes]
+
+        self.assertEqual(strides, [8] * 4 + [4] * 5 + [2] * 16 + [1] * 56)
+        self.assertEqual(indexes[:4], [(0, 0), (0, 8), (8, 0), (8, 8)])
+        self.assertEqual(indexes[4:9], [(0, 4), (4, 0), (4, 4), (4, 8), (8, 4)])
+        for start, end in [(9, 25), (25, 81)]:
+            self.assertEqual(indexes[start:end], sorted(indexes[start:end]))
+
+    def test_coarsest_stride_follows_the_longer_side(self):
+        coords = [(121.0 + (i * 0.5), 14.0) for i in range(6)]
+
+        ordered = utils.progressive_order(coords, 0.5)
+
+        self.assertEqual([int((lon - 121.0) / 0.5) for lon, lat in ordered],
+                         [0, 4, 2, 1, 3, 5])
+
+    def test_single_point(self):
+        self.assertEqual(utils.progressive_order([(121.0, 14.0)], 0.5),
+                         [(121.0, 14.0)])
+
+
+class CoordsFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, text, **kwargs):
+        path = os.path.join(self.tmp, 'coords.txt')
+        with open(path, 'w') as f:
+            f.write(text)
+        return utils.read_coords_file(path, **kwargs)
+
+    def test_comment_lines_are_skipped(self):
+        coords = self.read("# station export\n121.0,14.0\n121.5,14.25\n")
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+    def test_header_is_skipped(self):
+        coords = self.read("lon,lat\n121.0,14.0\n121.5,14.25\n")
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+    def test_comment_and_header(self):
+        coords = self.read("# exported\n# by hand\nlon;lat\n121.0;14.0\n")
+
+        self.assertEqual(coords, [(121.0, 14.0)])
+
+    def test_blank_lines_are_skipped(self):
+        coords = self.read("\n121.0,14.0\n\n   \n121.5,14.25\n\n")
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+    def test_semicolon_delimiter(self):
+        coords = self.read("121.0; 14.0\n121.5; 14.25\n")
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+    def test_tab_delimiter(self):
+        coords = self.read("121.0\t14.0\t5\n121.5\t14.25\t6\n")
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+    def test_whitespace_delimiter(self):
+        coords = self.read("x y\n  121.0   14.0\n121.5 14.25\n")
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+    def test_row_not_matching_the_layout_is_not_a_header(self):
+        with self.assertRaises(ValueError) as cm:
+            self.read("121.0,14.0\n121.5 14.25\n122.0 14.5\n")
+
+        self.assertIn('line 1', str(cm.exception))
+
+    def test_invalid_row_raises(self):
+        with self.assertRaises(ValueError) as cm:
+            self.read("121.0,14.0\n121.5,abc\n")
+
+        self.assertIn('line 2', str(cm.exception))
+
+    def test_unique_and_decimals(self):
+        coords = self.read("121.001,14.0\n121.004,14.0\n121.5,14.25\n",
+                           decimals=2, unique=True)
+
+        self.assertEqual(coords, [(121.0, 14.0), (121.5, 14.25)])
+
+
+class SaveFileTest(unittest.TestCase):
+
+    def test_missing_save_file_has_no_points(self):
+        self.assertEqual(utils.load_downloaded_coords('/nonexistent/linke.csv'), set())
+
+    def test_filter_downloaded_compares_formatted_coordinates(self):
+        done = set([('121.00000', '14.00000')])
+        coords = [(121.000001, 14.0), (121.0001, 14.0)]
+
+        self.assertEqual(list(utils.filter_downloaded(coords, done)),
+                         [(121.0001, 14.0)])
+
+
+class DownloadLinkeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saveFile = os.path.join(self.tmp, 'linke.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read_lines(self, path):
+        with open(path) as f:
+            return f.read().splitlines()
+
+    def test_points_read_before_a_source_error_are_downloaded(self):
+        utils.download_linke(failing_coords(4), '', '', self.saveFile, 'w',
+                             provider=FakeProvider(batchSize=3))
+
+        self.assertEqual(len(self.read_lines(self.saveFile)), 4)
+        not_dl = self.read_lines(self.saveFile + "_notdownloaded.txt")
+        self.assertEqual(len(not_dl), 1)
+        self.assertTrue(not_dl[0].startswith('# '))
+        self.assertIn('line 5', not_dl[0])
+
+    def test_provider_error_records_the_remaining_points(self):
+        coords = [(121.0 + x, 14.0) for x in range(7)]
+
+        utils.download_linke(coords, '', '', self.saveFile, 'w',
+                             provider=FakeProvider(batchSize=3, fail=4))
+
+        self.assertEqual(len(self.read_lines(self.saveFile)), 4)
+        self.assertEqual(self.read_lines(self.saveFile + "_notdownloaded.txt"),
+                         ['125.0,14.0', '126.0,14.0', '127.0,14.0'])
+
+    def test_update_and_compact_round_trip(self):
+        utils.download_linke([(121.5, 14.0), (121.0, 14.0)], '', '',
+                             self.saveFile, 'w', provider=FakeProvider())
+
+        self.assertEqual(utils.load_downloaded_coords(self.saveFile),
+                         set([('121.00000', '14.00000'), ('121.50000', '14.00000')]))
+
+        provider = FakeProvider()
+        utils.download_linke([(121.0, 14.0), (120.5, 14.0)], '', '',
+                             self.saveFile, 'i', provider=provider)
+
+        self.assertEqual(provider.coords, [(120.5, 14.0)])
+
+        newer = [4.0] * 12
+        utils.download_linke([(121.5, 14.0)], '', '', self.saveFile, 'a',
+                             compact=True, provider=FakeProvider(linkes=newer))
+
+        lines = self.read_lines(self.saveFile)
+        self.assertEqual([l.split(',')[0] for l in lines],
+                         ['120.50000', '121.00000', '121.50000'])
+        self.assertEqual(lines[2].split(',')[2:], ['4.0'] * 12)
+        self.assertFalse(os.path.exists(self.saveFile + '.tmp'))
+
+    def test_provider_and_source_errors_are_both_recorded(self):
+        utils.download_linke(failing_coords(5), '', '', self.saveFile, 'w',
+                             provider=FakeProvider(batchSize=3, fail=1))
+
+        not_dl = self.read_lines(self.saveFile + "_notdownloaded.txt")
+        self.assertEqual(not_dl[:4], ['122.0,14.0', '123.0,14.0',
+                                      '124.0,14.0', '125.0,14.0'])
+        self.assertIn('line 6', not_dl[4])
+
+
+class ProxyPoolTest(unittest.TestCase):
+
+    def make_pool(self, **kwargs):
+        return utils.ProxyPool(['http://a:8080', 'http://b:8080'], **kwargs)
+
+    def release_later(self, pool, state, ok=True, delay=0.1):
+        timer = threading.Timer(delay, pool.release, (state, 0.1, ok))
+        timer.start()
+        return timer
+
+    def test_least_outstanding(self):
+        pool = self.make_pool()
+        a = pool.acquire()
+        b = pool.acquire()
+        pool.release(a, 0.1, True)
+
+        self.assertIsNot(a, b)
+        self.assertIs(pool.acquire(), a)
+
+    def test_roundrobin(self):
+        pool = self.make_pool(policy='roundrobin')
+        picked = [pool.acquire().url for _ in range(4)]
+
+        self.assertEqual(picked, ['http://a:8080', 'http://b:8080',
+                                  'http://a:8080', 'http://b:8080'])
+
+    def test_consecutive_errors_eject(self):
+        pool = self.make_pool(maxErrors=2, retryAfter=60)
+        a = pool.states[0]
+        for _ in range(2):
+            pool.release(pool.acquire(exclude=[pool.states[1]]), 0.1, False)
+
+        self.assertIsNotNone(a.ejected)
+        self.assertEqual(pool.healthy(), 1)
+        self.assertIs(pool.acquire(), pool.states[1])
+
+    def test_slow_proxy_is_ejected(self):
+        pool = self.make_pool(maxLatency=1.0, retryAfter=60)
+        a = pool.acquire()
+        pool.release(a, 5.0, True)
+
+        self.assertIsNotNone(a.ejected)
+
+    def test_ejected_proxy_returns_on_probation(self):
+        pool = self.make_pool(retryAfter=0)
+        a, b = pool.states
+        pool.eject(a)
+        pool.eject(b)
+
+        first = pool.acquire()
+        second = pool.acquire()
+
+        self.assertEqual(set([first, second]), set([a, b]))
+        self.assertTrue(a.probation and b.probation)
+        self.assertIsNone(a.ejected)
+
+        pool.release(first, 0.1, True)
+        self.assertFalse(first.probation)
+
+        pool.release(second, 0.1, False)
+        self.assertIsNotNone(second.ejected)
+
+    def test_acquire_waits_for_a_proxy_on_probation(self):
+        pool = self.make_pool(retryAfter=0)
+        for state in pool.states:
+            pool.eject(state)
+        first = pool.acquire()
+        pool.acquire()
+
+        timer = self.release_later(pool, first)
+        self.assertIs(pool.acquire(timeout=5), first)
+        timer.join()
+
+    def test_acquire_waits_for_an_ejected_proxy_to_be_retried(self):
+        pool = self.make_pool(retryAfter=0.2)
+        for state in pool.states:
+            pool.eject(state)
+
+        started = time.time()
+        state = pool.acquire(timeout=5)
+
+        self.assertGreaterEqual(time.time() - started, 0.15)
+        self.assertTrue(state.probation)
+
+    def test_acquire_raises_after_the_timeout(self):
+        pool = self.make_pool(retryAfter=60)
+        for state in pool.states:
+            pool.eject(state)
+
+        self.assertRaises(IOError, pool.acquire, timeout=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()